@@ -1,22 +1,41 @@
 import os
-import subprocess
+import signal
+import socket
 import threading
 import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Dict, Tuple
+from typing import Deque, Dict, List, Mapping, Optional, Sequence, Tuple
 
 
 class InstanceError(RuntimeError):
     """Raised when a per-session instance cannot be provisioned."""
 
 
-@dataclass
+# Environment variables dosbox needs from the service's own environment.
+# XKB_DEFAULT_LAYOUT is exported by start.sh to select the keyboard layout.
+_DOSBOX_ENV_KEYS = ("PATH", "HOME", "USER", "LANG", "XAUTHORITY", "XKB_DEFAULT_LAYOUT")
+
+# Delay between warm-pool launch attempts after a failure, doubling up to the max.
+_REFILL_BACKOFF_MIN = 1.0
+_REFILL_BACKOFF_MAX = 60.0
+
+# Children are launched with posix_spawn rather than fork+exec so the
+# service's address space is never duplicated just to start a process.
+_QUIET_FILE_ACTIONS = [
+    (os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0),
+    (os.POSIX_SPAWN_OPEN, 2, os.devnull, os.O_WRONLY, 0),
+]
+
+
+@dataclass(slots=True)
 class Instance:
     session_id: str
     username: str
     display: int
     websocket_port: int
-    processes: Tuple[subprocess.Popen, ...]
+    processes: Tuple[int, ...]
 
 
 class InstanceManager:
@@ -32,6 +51,7 @@ class InstanceManager:
         dosbox_binary: str = "dosbox",
         vnc_binary: str = "vncserver",
         websockify_binary: str = "websockify",
+        warm_instances: int = 0,
     ) -> None:
         self.base_display = base_display
         self.max_instances = max_instances
@@ -42,34 +62,139 @@ class InstanceManager:
         self.dosbox_binary = dosbox_binary
         self.vnc_binary = vnc_binary
         self.websockify_binary = websockify_binary
-        self._instances: Dict[str, Instance] = {}
+        self.warm_instances = warm_instances
+        self._dosbox_env_template = {key: os.environ[key] for key in _DOSBOX_ENV_KEYS if key in os.environ}
+        # Read-copy-update: the mapping is never mutated in place. Writers build a
+        # new dict under ``_lock`` and swap the reference, so readers can look
+        # sessions up without taking any lock.
+        self._instances: Mapping[str, Instance] = {}
+        self._free_slots: Deque[Tuple[int, int]] = deque(
+            (base_display + offset, base_websocket_port + offset) for offset in range(max_instances)
+        )
+        # Pre-provisioned instances not yet bound to a session; kept topped up
+        # to ``warm_instances`` by the refill thread.
+        self._warm: Deque[Instance] = deque()
+        # Slots of sessions restored from the store, keyed by session ID, so
+        # neither the warm pool nor new logins take them before they resume.
+        self._reserved: Dict[str, Tuple[int, int]] = {}
+        self._refill_needed = threading.Event()
+        self._refill_thread: Optional[threading.Thread] = None
+        self._closing = threading.Event()
         self._lock = threading.Lock()
+        # Number of slots the refill thread has taken but not yet added to
+        # ``_warm``; logins that find no capacity wait on ``_warm_ready`` for them.
+        self._warming = 0
+        self._warm_ready = threading.Condition(self._lock)
+        # Long-lived workers for callers that need to run blocking instance
+        # operations off their own thread (e.g. the async session store).
+        self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="spawn")
+
+    def _publish(self, instance: Instance) -> None:
+        self._instances = {**self._instances, instance.session_id: instance}
+
+    def _unpublish(self, session_id: str) -> Optional[Instance]:
+        instance = self._instances.get(session_id)
+        if instance is not None:
+            self._instances = {key: value for key, value in self._instances.items() if key != session_id}
+        return instance
 
     def _allocate_slot(self) -> Tuple[int, int]:
-        used_displays = {instance.display for instance in self._instances.values()}
-        for offset in range(self.max_instances):
-            display = self.base_display + offset
-            if display not in used_displays:
-                ws_port = self.base_websocket_port + offset
-                return display, ws_port
-        raise InstanceError("No free session slots available")
-
-    def _spawn_process(self, command, env=None) -> subprocess.Popen:
-        return subprocess.Popen(
+        try:
+            return self._free_slots.popleft()
+        except IndexError:
+            raise InstanceError("No free session slots available") from None
+
+    def reserve_slot(self, session_id: str, display: int, websocket_port: int) -> None:
+        """Hold a restored session's slot until ensure_session resumes it."""
+        with self._lock:
+            try:
+                self._free_slots.remove((display, websocket_port))
+            except ValueError:
+                raise InstanceError(f"Display :{display} is already in use") from None
+            self._reserved[session_id] = (display, websocket_port)
+
+    def _claim_slot(self, session_id: str, display: int, websocket_port: int) -> None:
+        # A reservation is kept until the resumed instance is published, so the
+        # session stays visible to stop_session while it is being launched.
+        if self._reserved.get(session_id) == (display, websocket_port):
+            return
+        try:
+            self._free_slots.remove((display, websocket_port))
+        except ValueError:
+            raise InstanceError(f"Display :{display} is already in use") from None
+
+    def _release_slot(self, display: int, websocket_port: int) -> None:
+        with self._lock:
+            self._free_slots.append((display, websocket_port))
+        self._refill_needed.set()
+
+    def _spawn_process(self, command: Sequence[str], env=None) -> int:
+        return os.posix_spawnp(
+            command[0],
             command,
-            env=env,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            start_new_session=True,
+            os.environ if env is None else env,
+            file_actions=_QUIET_FILE_ACTIONS,
+            setsid=True,
         )
 
+    def _run(self, command: Sequence[str]) -> Tuple[int, str]:
+        """Run ``command`` to completion, returning its exit code and stderr."""
+        read_fd, write_fd = os.pipe()
+        try:
+            pid = os.posix_spawnp(
+                command[0],
+                command,
+                os.environ,
+                file_actions=[
+                    (os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0),
+                    (os.POSIX_SPAWN_DUP2, write_fd, 2),
+                ],
+            )
+        except BaseException:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        with os.fdopen(read_fd, "rb") as stderr:
+            output = stderr.read()
+        _, wait_status = os.waitpid(pid, 0)
+        return os.waitstatus_to_exitcode(wait_status), output.decode("utf-8", "ignore")
+
+    @staticmethod
+    def _is_running(pid: int) -> bool:
+        try:
+            return os.waitpid(pid, os.WNOHANG) == (0, 0)
+        except ChildProcessError:
+            return False
+
+    def _stop_processes(self, pids: Sequence[int], timeout: float = 1) -> None:
+        """Signal every process first, then wait for all of them together."""
+        running = [pid for pid in pids if self._is_running(pid)]
+        for pid in running:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + timeout
+        while running:
+            running = [pid for pid in running if self._is_running(pid)]
+            if not running:
+                return
+            if time.monotonic() >= deadline:
+                for pid in running:
+                    try:
+                        os.kill(pid, signal.SIGKILL)
+                        os.waitpid(pid, 0)
+                    except (ProcessLookupError, ChildProcessError):
+                        pass
+                return
+            time.sleep(0.05)
+
+    def _kill_vnc(self, display: int) -> None:
+        self._run([self.vnc_binary, "-kill", f":{display}"])
+
     def _start_vnc(self, display: int) -> None:
-        subprocess.run(
-            [self.vnc_binary, "-kill", f":{display}"],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            check=False,
-        )
+        self._kill_vnc(display)
         cmd = [
             self.vnc_binary,
             f":{display}",
@@ -79,15 +204,24 @@ class InstanceManager:
             str(self.depth),
             "-localhost",
         ]
-        completed = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False)
-        if completed.returncode != 0:
-            raise InstanceError(
-                f"Failed to start VNC server (display :{display}): {completed.stderr.decode('utf-8', 'ignore')}"
-            )
+        returncode, stderr = self._run(cmd)
+        if returncode != 0:
+            raise InstanceError(f"Failed to start VNC server (display :{display}): {stderr}")
+
+    def _wait_vnc_ready(self, display: int, timeout: float = 3.0) -> None:
+        address = ("127.0.0.1", 5900 + display)
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                with socket.create_connection(address, timeout=0.05):
+                    return
+            except OSError:
+                if time.monotonic() >= deadline:
+                    raise InstanceError(f"VNC server on display :{display} did not become ready")
+                time.sleep(0.01)
 
-    def _start_dosbox(self, display: int) -> subprocess.Popen:
-        env = os.environ.copy()
-        env["DISPLAY"] = f":{display}"
+    def _start_dosbox(self, display: int) -> int:
+        env = {**self._dosbox_env_template, "DISPLAY": f":{display}"}
         return self._spawn_process(
             [
                 self.dosbox_binary,
@@ -98,7 +232,7 @@ class InstanceManager:
             env=env,
         )
 
-    def _start_websockify(self, websocket_port: int, display: int) -> subprocess.Popen:
+    def _start_websockify(self, websocket_port: int, display: int) -> int:
         target = f"localhost:{5900 + display}"
         return self._spawn_process(
             [
@@ -110,95 +244,216 @@ class InstanceManager:
             ]
         )
 
+    def _launch(self, display: int, websocket_port: int, websockify: bool = True) -> Tuple[int, ...]:
+        processes: List[int] = []
+        try:
+            self._start_vnc(display)
+            self._wait_vnc_ready(display)
+            processes.append(self._start_dosbox(display))
+            if websockify:
+                processes.append(self._start_websockify(websocket_port, display))
+        except Exception:  # pragma: no cover - defensive cleanup
+            self._stop_processes(processes)
+            self._kill_vnc(display)
+            raise
+        return tuple(processes)
+
+    @staticmethod
+    def _kill_processes(pids: Sequence[int]) -> None:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+    def _teardown(self, instance: Instance, fast: bool = False) -> None:
+        # Start the VNC kill without waiting so it overlaps with stopping the
+        # session's own processes; teardown then takes the longest of the two.
+        kill_pid = self._spawn_process([self.vnc_binary, "-kill", f":{instance.display}"])
+        if fast:
+            # dosbox and websockify have nothing to flush; skip the grace period
+            # and do not wait on anything.
+            self._kill_processes(instance.processes)
+            return
+        self._stop_processes(instance.processes)
+        try:
+            os.waitpid(kill_pid, 0)
+        except ChildProcessError:
+            pass
+        # Only hand the slot out again once its display has been torn down.
+        self._release_slot(instance.display, instance.websocket_port)
+
+    def start_warm_pool(self) -> None:
+        if self.warm_instances <= 0 or self._refill_thread is not None:
+            return
+        self._refill_thread = threading.Thread(target=self._refill_loop, name="warm-pool", daemon=True)
+        self._refill_thread.start()
+        self._refill_needed.set()
+
+    def _refill_loop(self) -> None:
+        backoff = _REFILL_BACKOFF_MIN
+        while True:
+            self._refill_needed.wait()
+            self._refill_needed.clear()
+            if self._closing.is_set():
+                return
+            if self._refill():
+                backoff = _REFILL_BACKOFF_MIN
+                continue
+            # A warm launch failed; wait before trying again so a broken VNC
+            # setup does not turn into a tight respawn loop.
+            if self._closing.wait(backoff):
+                return
+            backoff = min(backoff * 2, _REFILL_BACKOFF_MAX)
+            self._refill_needed.set()
+
+    def _refill(self) -> bool:
+        """Top up the warm pool; returns False if a launch failed."""
+        while not self._closing.is_set():
+            with self._lock:
+                if len(self._warm) >= self.warm_instances or not self._free_slots:
+                    return True
+                display, ws_port = self._allocate_slot()
+                self._warming += 1
+            try:
+                # websockify exits after its idle timeout with no client, so
+                # warm instances only run VNC and dosbox; it is started on claim.
+                processes = self._launch(display, ws_port, websockify=False)
+            except Exception:  # pragma: no cover - retried after a backoff
+                # Put the slot back directly: _release_slot would wake this
+                # thread again straight away.
+                with self._lock:
+                    self._warming -= 1
+                    self._free_slots.append((display, ws_port))
+                    self._warm_ready.notify_all()
+                return False
+            instance = Instance(
+                session_id="",
+                username="",
+                display=display,
+                websocket_port=ws_port,
+                processes=processes,
+            )
+            with self._lock:
+                self._warming -= 1
+                self._warm_ready.notify_all()
+                if not self._closing.is_set():
+                    self._warm.append(instance)
+                    continue
+            self._teardown(instance)
+        return True
+
+    def _take_warm(self) -> Optional[Instance]:
+        while self._warm:
+            instance = self._warm.popleft()
+            self._refill_needed.set()
+            if all(self._is_running(pid) for pid in instance.processes):
+                return instance
+            # Something in the warm instance died while it sat in the pool;
+            # clean it up in the background rather than handing it out.
+            self.executor.submit(self._teardown, instance)
+        return None
+
+    def _activate(self, instance: Instance, session_id: str, username: str) -> None:
+        try:
+            ws_pid = self._start_websockify(instance.websocket_port, instance.display)
+        except Exception as exc:  # pragma: no cover - defensive cleanup
+            self.executor.submit(self._teardown, instance)
+            raise InstanceError(f"Failed to start websockify: {exc}") from exc
+        instance.processes = instance.processes + (ws_pid,)
+        instance.session_id = session_id
+        instance.username = username
+        self._publish(instance)
+
     def start_session(self, session_id: str, username: str) -> Tuple[int, int]:
+        instance = self._instances.get(session_id)
+        if instance is not None:
+            return instance.display, instance.websocket_port
         with self._lock:
-            if session_id in self._instances:
-                instance = self._instances[session_id]
+            instance = self._instances.get(session_id)
+            if instance is not None:
+                return instance.display, instance.websocket_port
+
+            instance = self._take_warm()
+            # The last free slot may be mid-launch in the refill thread; wait
+            # for it rather than failing the login while capacity exists.
+            while instance is None and not self._free_slots and self._warming:
+                self._warm_ready.wait()
+                instance = self._take_warm()
+            if instance is not None:
+                self._activate(instance, session_id, username)
                 return instance.display, instance.websocket_port
 
             display, ws_port = self._allocate_slot()
-            processes = []
             try:
-                self._start_vnc(display)
-                time.sleep(1)  # allow VNC to initialize
-                dosbox_proc = self._start_dosbox(display)
-                processes.append(dosbox_proc)
-                ws_proc = self._start_websockify(ws_port, display)
-                processes.append(ws_proc)
+                processes = self._launch(display, ws_port)
             except Exception as exc:  # pragma: no cover - defensive cleanup
-                for proc in processes:
-                    if proc.poll() is None:
-                        proc.terminate()
-                subprocess.run(
-                    [self.vnc_binary, "-kill", f":{display}"],
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL,
-                    check=False,
-                )
+                self._free_slots.append((display, ws_port))
                 raise InstanceError(f"Failed to provision session: {exc}") from exc
 
-            self._instances[session_id] = Instance(
-                session_id=session_id,
-                username=username,
-                display=display,
-                websocket_port=ws_port,
-                processes=tuple(processes),
+            self._publish(
+                Instance(
+                    session_id=session_id,
+                    username=username,
+                    display=display,
+                    websocket_port=ws_port,
+                    processes=processes,
+                )
             )
             return display, ws_port
 
+    def has_session(self, session_id: str) -> bool:
+        return session_id in self._instances
+
     def ensure_session(self, session_id: str, username: str, display: int, websocket_port: int) -> None:
+        if session_id in self._instances:
+            return
         with self._lock:
             if session_id in self._instances:
                 return
-            processes = []
+            self._claim_slot(session_id, display, websocket_port)
             try:
-                self._start_vnc(display)
-                time.sleep(1)
-                dosbox_proc = self._start_dosbox(display)
-                processes.append(dosbox_proc)
-                ws_proc = self._start_websockify(websocket_port, display)
-                processes.append(ws_proc)
+                processes = self._launch(display, websocket_port)
             except Exception as exc:  # pragma: no cover - defensive cleanup
-                for proc in processes:
-                    if proc.poll() is None:
-                        proc.terminate()
-                subprocess.run(
-                    [self.vnc_binary, "-kill", f":{display}"],
-                    stdout=subprocess.DEVNULL,
-                    stderr=subprocess.DEVNULL,
-                    check=False,
-                )
+                self._reserved.pop(session_id, None)
+                self._free_slots.append((display, websocket_port))
                 raise InstanceError(f"Failed to resume session: {exc}") from exc
-            self._instances[session_id] = Instance(
-                session_id=session_id,
-                username=username,
-                display=display,
-                websocket_port=websocket_port,
-                processes=tuple(processes),
+            self._reserved.pop(session_id, None)
+            self._publish(
+                Instance(
+                    session_id=session_id,
+                    username=username,
+                    display=display,
+                    websocket_port=websocket_port,
+                    processes=processes,
+                )
             )
 
-    def stop_session(self, session_id: str) -> None:
+    def stop_session(self, session_id: str, fast: bool = False) -> None:
+        # Decided under the lock: an ensure_session that is still launching this
+        # session holds it, so the stop waits and then sees the published
+        # instance instead of returning early and leaking it.
         with self._lock:
-            instance = self._instances.pop(session_id, None)
-        if not instance:
-            return
-        for proc in instance.processes:
-            if proc.poll() is None:
-                proc.terminate()
-                try:
-                    proc.wait(timeout=5)
-                except subprocess.TimeoutExpired:
-                    proc.kill()
-        subprocess.run(
-            [self.vnc_binary, "-kill", f":{instance.display}"],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-            check=False,
-        )
+            instance = self._unpublish(session_id)
+            if instance is None:
+                slot = self._reserved.pop(session_id, None)
+                if slot is not None:
+                    self._free_slots.append(slot)
+                    self._refill_needed.set()
+                return
+        self._teardown(instance, fast=fast)
 
     def stop_all(self) -> None:
         with self._lock:
-            session_ids = list(self._instances.keys())
+            self._closing.set()
+            warm = list(self._warm)
+            self._warm.clear()
+            session_ids = list(self._instances)
+        self._refill_needed.set()
+        if self._refill_thread is not None:
+            self._refill_thread.join(timeout=10)
+        for instance in warm:
+            self._teardown(instance, fast=True)
         for session_id in session_ids:
-            self.stop_session(session_id)
-
+            self.stop_session(session_id, fast=True)
+        self.executor.shutdown(wait=False)
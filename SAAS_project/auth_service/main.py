@@ -1,12 +1,20 @@
+import asyncio
+import hmac
 import json
+import logging
 import os
-import sqlite3
-import threading
+import re
+import struct
+import sys
 import time
 import uuid
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, Optional
+from types import MappingProxyType
+from typing import AsyncIterator, Callable, Dict, List, Mapping, Optional, Set, Tuple, TypeVar
 
+import lmdb
 from fastapi import Depends, FastAPI, HTTPException, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, PlainTextResponse
@@ -14,8 +22,11 @@ from pydantic import BaseModel
 from instance_manager import InstanceError, InstanceManager
 
 
+logger = logging.getLogger(__name__)
+T = TypeVar("T")
+
 DEFAULT_USERS_FILE = "/config/users.json"
-DEFAULT_DB_PATH = "/var/lib/session.db"
+DEFAULT_DB_PATH = "/var/lib/session.lmdb"
 DEFAULT_IDLE_TIMEOUT = 900  # 15 minutes
 DEFAULT_ABSOLUTE_TIMEOUT = 28800  # 8 hours
 DEFAULT_BASE_DISPLAY = 11
@@ -24,9 +35,11 @@ DEFAULT_BASE_WEBSOCKET_PORT = 7700
 DEFAULT_VNC_GEOMETRY = "1024x768"
 DEFAULT_VNC_DEPTH = 24
 DEFAULT_DOSBOX_CONF = "/root/.dosbox/dosbox-0.74-3.conf"
+DEFAULT_WARM_INSTANCES = 1
+DEFAULT_SWEEP_INTERVAL = 30  # seconds
 
 
-def load_users(file_path: str) -> Dict[str, str]:
+def load_users(file_path: str) -> Mapping[str, str]:
     path = Path(file_path)
     if not path.exists():
         raise RuntimeError(f"User config not found at {file_path}")
@@ -34,10 +47,44 @@ def load_users(file_path: str) -> Dict[str, str]:
         data = json.load(handle)
     if not isinstance(data, dict) or not data:
         raise RuntimeError("User configuration must be a non-empty object")
-    return {str(user): str(password) for user, password in data.items()}
+    # Loaded once at startup and never mutated, so hand out a read-only view.
+    return MappingProxyType(
+        {sys.intern(str(user)): sys.intern(str(password)) for user, password in data.items()}
+    )
+
+
+# Session IDs are issued as str(uuid.uuid4()); anything else can be rejected
+# before touching the store.
+_SESSION_ID_RE = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+# Fixed-size header of a stored session: created_at, last_seen, display,
+# websocket_port. The UTF-8 username follows it.
+_SESSION_RECORD = struct.Struct("<qqii")
+
+
+@dataclass(slots=True)
+class Session:
+    session_id: str
+    username: str
+    display: int
+    websocket_port: int
+    created_at: int
+    last_seen: int
+
+    def to_record(self) -> bytes:
+        header = _SESSION_RECORD.pack(self.created_at, self.last_seen, self.display, self.websocket_port)
+        return header + self.username.encode("utf-8")
+
+    @classmethod
+    def from_record(cls, session_id: str, record: bytes) -> "Session":
+        created_at, last_seen, display, websocket_port = _SESSION_RECORD.unpack_from(record)
+        username = bytes(record[_SESSION_RECORD.size :]).decode("utf-8")
+        return cls(session_id, username, display, websocket_port, created_at, last_seen)
 
 
 class SessionStore:
+    """Sessions live in memory; an LMDB file is a write-behind copy for restarts."""
+
     def __init__(
         self,
         db_path: str,
@@ -49,84 +96,124 @@ class SessionStore:
         self.idle_timeout = idle_timeout
         self.absolute_timeout = absolute_timeout
         self.instance_manager = instance_manager
-        self._lock = threading.Lock()
+        self._lock = asyncio.Lock()
+        self._env: Optional[lmdb.Environment] = None
+        self._sessions: Dict[str, Session] = {}
+        # last_seen bumps are only persisted on the next sweep; losing a few
+        # seconds of idle time on a crash is harmless.
+        self._touched: Set[str] = set()
+        # (key, record) pairs; a record of None deletes the key.
+        self._writes: "asyncio.Queue[Tuple[bytes, Optional[bytes]]]" = asyncio.Queue()
+        self._writer: Optional[asyncio.Task] = None
         Path(db_path).parent.mkdir(parents=True, exist_ok=True)
-        self._initialize()
-
-    def _connect(self) -> sqlite3.Connection:
-        return sqlite3.connect(self.db_path, check_same_thread=False)
-
-    def _initialize(self) -> None:
-        with self._connect() as conn:
-            conn.execute(
-                """
-                CREATE TABLE IF NOT EXISTS sessions (
-                    session_id TEXT PRIMARY KEY,
-                    username TEXT NOT NULL,
-                    display INTEGER,
-                    websocket_port INTEGER,
-                    created_at INTEGER NOT NULL,
-                    last_seen INTEGER NOT NULL
+
+    async def open(self) -> None:
+        self._env = lmdb.open(self.db_path, map_size=1 << 24, subdir=False, writemap=True, map_async=True)
+        with self._env.begin() as txn:
+            for key, record in txn.cursor():
+                session_id = key.decode("ascii")
+                self._sessions[session_id] = Session.from_record(session_id, record)
+        # Hold restored sessions' slots before anything else (the warm pool, new
+        # logins) can allocate them.
+        for session in list(self._sessions.values()):
+            try:
+                self.instance_manager.reserve_slot(
+                    session.session_id, session.display, session.websocket_port
                 )
-                """
-            )
-            columns = {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}
-            if "display" not in columns:
-                conn.execute("ALTER TABLE sessions ADD COLUMN display INTEGER")
-            if "websocket_port" not in columns:
-                conn.execute("ALTER TABLE sessions ADD COLUMN websocket_port INTEGER")
-            conn.commit()
-
-    def _cleanup_expired(self, conn: sqlite3.Connection, now_ts: int) -> None:
+            except InstanceError:
+                logger.warning("Dropping restored session %s: its slot is unavailable", session.session_id)
+                del self._sessions[session.session_id]
+                self._persist(session.session_id, None)
+        self._writer = asyncio.create_task(self._write_behind())
+
+    async def close(self) -> None:
+        if self._env is None:
+            return
+        self._flush_touched()
+        await self._writes.join()
+        self._writer.cancel()
+        self._env.close()
+        self._env = None
+
+    async def _write_behind(self) -> None:
+        # This task is the store's only writer. Every put and delete goes
+        # through it one batch at a time, so no write can land inside another
+        # caller's transaction or be lost to its rollback.
+        while True:
+            batch = [await self._writes.get()]
+            while not self._writes.empty():
+                batch.append(self._writes.get_nowait())
+            try:
+                await asyncio.to_thread(self._apply, batch)
+            except Exception:  # pragma: no cover - the in-memory state stays authoritative
+                logger.exception("Failed to persist session changes")
+            finally:
+                for _ in batch:
+                    self._writes.task_done()
+
+    def _apply(self, batch: List[Tuple[bytes, Optional[bytes]]]) -> None:
+        with self._env.begin(write=True) as txn:
+            for key, record in batch:
+                if record is None:
+                    txn.delete(key)
+                else:
+                    txn.put(key, record)
+
+    def _persist(self, session_id: str, session: Optional[Session]) -> None:
+        record = session.to_record() if session is not None else None
+        self._writes.put_nowait((session_id.encode("ascii"), record))
+
+    def _flush_touched(self) -> None:
+        for session_id in self._touched:
+            session = self._sessions.get(session_id)
+            if session is not None:
+                self._persist(session_id, session)
+        self._touched.clear()
+
+    async def sweep_expired(self) -> None:
+        now_ts = int(time.time())
         stale_ids = [
-            row[0]
-            for row in conn.execute(
-                """
-                SELECT session_id FROM sessions
-                WHERE (? - last_seen) > ?
-                   OR (? - created_at) > ?
-                """,
-                (now_ts, self.idle_timeout, now_ts, self.absolute_timeout),
-            ).fetchall()
+            session_id for session_id, session in self._sessions.items() if self._is_expired(session, now_ts)
         ]
-        conn.execute(
-            """
-            DELETE FROM sessions
-            WHERE (? - last_seen) > ?
-               OR (? - created_at) > ?
-            """,
-            (now_ts, self.idle_timeout, now_ts, self.absolute_timeout),
-        )
-        conn.commit()
         for session_id in stale_ids:
-            self.instance_manager.stop_session(session_id)
+            await self._remove(session_id)
+        self._flush_touched()
+
+    def _is_expired(self, session: Session, now_ts: int) -> bool:
+        return (
+            now_ts - session.last_seen > self.idle_timeout
+            or now_ts - session.created_at > self.absolute_timeout
+        )
+
+    async def _run_instance_op(self, func: Callable[..., T], *args) -> T:
+        # Instance operations block on process spawns and waits; run them on the
+        # manager's dedicated spawn pool rather than the default executor.
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.instance_manager.executor, func, *args)
 
-    def create_session(self, username: str) -> Dict[str, int]:
+    async def _remove(self, session_id: str) -> None:
+        # Popping first makes concurrent removals of the same session no-ops.
+        if self._sessions.pop(session_id, None) is None:
+            return
+        self._touched.discard(session_id)
+        self._persist(session_id, None)
+        await self._run_instance_op(self.instance_manager.stop_session, session_id)
+
+    async def create_session(self, username: str) -> Dict[str, int]:
         session_id = str(uuid.uuid4())
         now_ts = int(time.time())
-        with self._lock:
-            with self._connect() as conn:
-                old_sessions = [
-                    row[0]
-                    for row in conn.execute(
-                        "SELECT session_id FROM sessions WHERE username = ?",
-                        (username,),
-                    ).fetchall()
-                ]
-                conn.execute("DELETE FROM sessions WHERE username = ?", (username,))
-                conn.commit()
+        async with self._lock:
+            old_sessions = [
+                existing_id for existing_id, session in self._sessions.items() if session.username == username
+            ]
             for existing_session in old_sessions:
-                self.instance_manager.stop_session(existing_session)
-            display, ws_port = self.instance_manager.start_session(session_id, username)
-            with self._connect() as conn:
-                conn.execute(
-                    """
-                    INSERT INTO sessions (session_id, username, display, websocket_port, created_at, last_seen)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                    """,
-                    (session_id, username, display, ws_port, now_ts, now_ts),
-                )
-                conn.commit()
+                await self._remove(existing_session)
+            display, ws_port = await self._run_instance_op(
+                self.instance_manager.start_session, session_id, username
+            )
+            session = Session(session_id, username, display, ws_port, now_ts, now_ts)
+            self._sessions[session_id] = session
+            self._persist(session_id, session)
         return {
             "session_id": session_id,
             "created_at": now_ts,
@@ -134,48 +221,43 @@ class SessionStore:
             "websocket_port": ws_port,
         }
 
-    def validate(self, session_id: str) -> Optional[Dict[str, int]]:
-        if not session_id:
+    async def validate(self, session_id: str) -> Optional[Dict[str, int]]:
+        if not session_id or not _SESSION_ID_RE.fullmatch(session_id):
             return None
         now_ts = int(time.time())
-        with self._lock, self._connect() as conn:
-            self._cleanup_expired(conn, now_ts)
-            row = conn.execute(
-                """
-                SELECT username, created_at, last_seen, display, websocket_port
-                FROM sessions
-                WHERE session_id = ?
-                """,
-                (session_id,),
-            ).fetchone()
-            if not row:
-                return None
-            last_seen = row[2]
-            # Update last_seen atomically
-            conn.execute(
-                "UPDATE sessions SET last_seen = ? WHERE session_id = ?",
-                (now_ts, session_id),
-            )
-            conn.commit()
-        display, ws_port = row[3], row[4]
-        if display is None or ws_port is None:
+        session = self._sessions.get(session_id)
+        if session is None:
+            return None
+        if self._is_expired(session, now_ts):
+            await self._remove(session_id)
             return None
-        self.instance_manager.ensure_session(session_id, row[0], display, ws_port)
+        session.last_seen = now_ts
+        self._touched.add(session_id)
+        if not self.instance_manager.has_session(session_id):
+            await self._run_instance_op(
+                self.instance_manager.ensure_session,
+                session_id,
+                session.username,
+                session.display,
+                session.websocket_port,
+            )
+            # The session may have been removed (logout, re-login, sweep) while
+            # its instance was resuming; don't report it valid or keep the instance.
+            if self._sessions.get(session_id) is not session:
+                await self._run_instance_op(self.instance_manager.stop_session, session_id)
+                return None
         return {
-            "username": row[0],
-            "created_at": row[1],
-            "last_seen": last_seen,
-            "display": display,
-            "websocket_port": ws_port,
+            "username": session.username,
+            "created_at": session.created_at,
+            "last_seen": session.last_seen,
+            "display": session.display,
+            "websocket_port": session.websocket_port,
         }
 
-    def delete(self, session_id: str) -> None:
+    async def delete(self, session_id: str) -> None:
         if not session_id:
             return
-        with self._lock, self._connect() as conn:
-            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
-            conn.commit()
-        self.instance_manager.stop_session(session_id)
+        await self._remove(session_id)
 
 
 class LoginPayload(BaseModel):
@@ -202,6 +284,8 @@ BASE_WS_PORT = int(os.getenv("SESSION_BASE_WEBSOCKET_PORT", DEFAULT_BASE_WEBSOCK
 VNC_GEOMETRY = os.getenv("SESSION_VNC_GEOMETRY", DEFAULT_VNC_GEOMETRY)
 VNC_DEPTH = int(os.getenv("SESSION_VNC_DEPTH", DEFAULT_VNC_DEPTH))
 DOSBOX_CONF = os.getenv("SESSION_DOSBOX_CONF", DEFAULT_DOSBOX_CONF)
+WARM_INSTANCES = int(os.getenv("SESSION_WARM_INSTANCES", DEFAULT_WARM_INSTANCES))
+SWEEP_INTERVAL = int(os.getenv("SESSION_SWEEP_INTERVAL", DEFAULT_SWEEP_INTERVAL))
 
 USERS = load_users(USERS_FILE)
 INSTANCE_MANAGER = InstanceManager(
@@ -211,10 +295,34 @@ INSTANCE_MANAGER = InstanceManager(
     geometry=VNC_GEOMETRY,
     depth=VNC_DEPTH,
     dosbox_conf=DOSBOX_CONF,
+    warm_instances=WARM_INSTANCES,
 )
 SESSION_STORE = SessionStore(DB_PATH, IDLE_TIMEOUT, ABSOLUTE_TIMEOUT, INSTANCE_MANAGER)
 
-app = FastAPI(title="secureDos session service", version="1.0.0")
+
+async def sweep_sessions() -> None:
+    while True:
+        await asyncio.sleep(SWEEP_INTERVAL)
+        try:
+            await SESSION_STORE.sweep_expired()
+        except Exception:  # pragma: no cover - keep sweeping on transient errors
+            logger.exception("Expired session sweep failed")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI) -> AsyncIterator[None]:
+    await SESSION_STORE.open()
+    INSTANCE_MANAGER.start_warm_pool()
+    sweeper = asyncio.create_task(sweep_sessions())
+    try:
+        yield
+    finally:
+        sweeper.cancel()
+        await asyncio.to_thread(INSTANCE_MANAGER.stop_all)
+        await SESSION_STORE.close()
+
+
+app = FastAPI(title="secureDos session service", version="1.0.0", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -225,15 +333,25 @@ app.add_middleware(
 )
 
 
-def get_session_id_from_request(request: Request) -> str:
-    cookie = request.cookies.get("SESSION_ID")
-    header = request.headers.get("X-Session-Id")
-    return header or cookie or ""
+async def get_session_id_from_request(request: Request) -> str:
+    # Resolved once per request and cached on request.state. The header is read
+    # straight from the ASGI scope (names are already lower-cased) to skip
+    # building Starlette's case-insensitive Headers wrapper.
+    session_id = getattr(request.state, "session_id", None)
+    if session_id is None:
+        session_id = ""
+        for name, value in request.scope["headers"]:
+            if name == b"x-session-id":
+                session_id = value.decode("latin-1")
+                break
+        if not session_id:
+            session_id = request.cookies.get("SESSION_ID", "")
+        request.state.session_id = session_id
+    return session_id
 
 
-def require_session(request: Request) -> Dict[str, int]:
-    session_id = get_session_id_from_request(request)
-    data = SESSION_STORE.validate(session_id)
+async def require_session(session_id: str = Depends(get_session_id_from_request)) -> Dict[str, int]:
+    data = await SESSION_STORE.validate(session_id)
     if not data:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized")
     data["session_id"] = session_id
@@ -241,17 +359,23 @@ def require_session(request: Request) -> Dict[str, int]:
 
 
 @app.get("/healthz", response_class=PlainTextResponse)
-def healthz() -> str:
+async def healthz() -> str:
     return "ok"
 
 
 @app.post("/api/login", response_model=SessionResponse)
-def login(payload: LoginPayload, response: Response):
+async def login(payload: LoginPayload, response: Response):
     expected_password = USERS.get(payload.username)
-    if expected_password is None or expected_password != payload.password:
+    # Constant-time comparison; unknown users are compared against an empty
+    # secret so they take the same path. Encoded because compare_digest only
+    # accepts ASCII str.
+    password_ok = hmac.compare_digest(
+        (expected_password or "").encode("utf-8"), payload.password.encode("utf-8")
+    )
+    if expected_password is None or not password_ok:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
     try:
-        session_data = SESSION_STORE.create_session(payload.username)
+        session_data = await SESSION_STORE.create_session(payload.username)
     except InstanceError as error:
         raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=str(error)) from error
     now_ts = session_data["created_at"]
@@ -274,15 +398,15 @@ def login(payload: LoginPayload, response: Response):
 
 
 @app.post("/api/logout")
-def logout(session=Depends(require_session)):
-    SESSION_STORE.delete(session["session_id"])
+async def logout(session=Depends(require_session)):
+    await SESSION_STORE.delete(session["session_id"])
     response = JSONResponse({"message": "logged out"})
     response.delete_cookie("SESSION_ID")
     return response
 
 
 @app.get("/api/session", response_model=SessionResponse)
-def get_session(session=Depends(require_session)):
+async def get_session(session=Depends(require_session)):
     return SessionResponse(
         username=session["username"],
         issued_at=session["created_at"],
@@ -294,9 +418,8 @@ def get_session(session=Depends(require_session)):
 
 
 @app.get("/internal/validate")
-def internal_validate(request: Request):
-    session_id = request.headers.get("x-session-id")
-    data = SESSION_STORE.validate(session_id)
+async def internal_validate(session_id: str = Depends(get_session_id_from_request)):
+    data = await SESSION_STORE.validate(session_id)
     if not data:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Unauthorized")
     headers = {